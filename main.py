@@ -1,70 +1,150 @@
+import argparse
+import os
 import signal
 import sys
-import time
+import threading
 import random
 import logging
-from vm import VirtualMachine
-
-# Set up global logging for main.
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("main.log"),
-        logging.StreamHandler()
-    ]
-)
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from vm import VirtualMachine, BUFFER_SIZE, disable_unused_log_fields
 
 logger = logging.getLogger("Main")
 virtual_machines = []
+vm_threads = {}
+log_listener = None
+stop_event = threading.Event()
+
+def configure_logging():
+    """Set up global logging for main; file/console I/O happens on a listener thread (see start_logging)."""
+    global log_listener
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.FileHandler("main.log", delay=True), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue(-1)
+    # Producers only enqueue records; formatting is left to the listener's handlers.
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper(), format='%(message)s',
+                        handlers=[QueueHandler(log_queue)], force=True)
+    log_listener = QueueListener(log_queue, *handlers)
+
+def start_logging():
+    """Start the listener thread; records logged before this wait in the queue until then."""
+    log_listener.start()
+
+def stop_logging():
+    """Flush pending log records and stop the listener thread."""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
 
-def setup_vms(num_vms=3, base_port=10000, min_rate=1, max_rate=6):
+def make_buffer_pool(count, size=BUFFER_SIZE):
+    """Create a thread-safe pool of reusable receive buffers."""
+    pool = queue.Queue()
+    for _ in range(count):
+        pool.put(bytearray(size))
+    return pool
+
+def setup_vms(num_vms=3, base_port=10000, min_rate=1, max_rate=6, buffer_pool=None):
     """Set up multiple VMs with unique ports, randomized clock rates, and peer lists."""
-    ports = [base_port + i for i in range(num_vms)]
+    ports = tuple(base_port + i for i in range(num_vms))
     for i in range(num_vms):
-        peer_ports = [p for p in ports if p != ports[i]]
+        peer_ports = ports[:i] + ports[i+1:]  # Immutable, so VMs cannot alter each other's peers
         clock_rate = random.randint(min_rate, max_rate)
-        vm = VirtualMachine(i+1, ports[i], peer_ports, clock_rate)
+        vm = VirtualMachine(i+1, ports[i], peer_ports, clock_rate, buffer_pool=buffer_pool)
         virtual_machines.append(vm)
-        logger.info(f"Created VM {i+1} on port {ports[i]} with clock rate {clock_rate} ticks/s")
+        logger.info("Created VM %d on port %d with clock rate %d ticks/s", i+1, ports[i], clock_rate)
     return virtual_machines
 
-def run_vms(vms):
-    """Start each VM process."""
-    for vm in vms:
-        vm.start()  # Launch each VM as a separate process.
-        logger.info(f"Started VM {vm.id}")
+def start_vm(vm, mode="process"):
+    """Start one VM as a separate process, or as a daemon thread in this process."""
+    if mode == "thread":
+        thread = threading.Thread(target=vm.run, daemon=True)
+        vm_threads[vm.id] = thread
+        thread.start()
+    else:
+        vm.start()  # Launch the VM as a separate process.
+    logger.info("Started VM %d", vm.id)
+
+def run_vms(vms, mode="process"):
+    """Start all VMs; VM processes are started one by one from the main thread."""
+    if not vms:
+        return
+    if mode != "thread":
+        # Forking is cheap, and forking from a pool worker would fork a multi-threaded parent
+        for vm in vms:
+            start_vm(vm, mode)
+        return
+    with ThreadPoolExecutor(max_workers=len(vms)) as executor:
+        list(executor.map(lambda vm: start_vm(vm, mode), vms))
+
+def join_vm(vm):
+    """Wait for one VM to finish, killing its process if it does not stop in time."""
+    thread = vm_threads.pop(vm.id, None)
+    if thread is not None:
+        thread.join(timeout=2)
+        if thread.is_alive():
+            logger.warning("VM %d did not terminate gracefully", vm.id)
+    elif vm.is_alive():
+        vm.join(timeout=2)  # Wait for the VM to finish its tick and flush its logs
+        if vm.is_alive():
+            logger.warning("VM %d did not terminate gracefully, killing...", vm.id)
+            vm.kill()  # SIGKILL cannot be caught, unlike the SIGTERM sent by stop_vms
 
 def stop_vms(vms):
-    """Stop all VM processes and wait for them to terminate."""
+    """Stop all VMs and wait for them to terminate."""
+    if not vms:
+        return
     for vm in vms:
-        if vm.is_alive():
-            vm.running = False  # Signal the process to stop
-            logger.info(f"Stopping VM {vm.id}")
-            vm.join(timeout=2)  # Wait for process to terminate
-            if vm.is_alive():
-                logger.warning(f"VM {vm.id} did not terminate gracefully, terminating...")
-                vm.terminate()  # Force terminate if it doesn't stop gracefully
+        # Signal every VM first so they all wind down together. A VM process has its own copy
+        # of `running`, so it is asked to stop with SIGTERM, which its run loop handles.
+        vm.running = False
+        if vm.id not in vm_threads and vm.is_alive():
+            vm.terminate()
+        logger.info("Stopping VM %d", vm.id)
+    # Join concurrently: the total wait is one timeout, not one per VM.
+    with ThreadPoolExecutor(max_workers=len(vms)) as executor:
+        list(executor.map(join_vm, vms))
 
 def signal_handler(sig, frame):
-    """Gracefully shut down all VMs on SIGINT."""
-    logger.info("Shutting down all virtual machines...")
-    stop_vms(virtual_machines)
-    logger.info("Shutdown complete. Exiting.")
-    sys.exit(0)
+    """Wake main() on SIGINT so it can shut down all VMs gracefully."""
+    stop_event.set()
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Lamport logical clock simulation")
+    parser.add_argument("--mode", choices=["process", "thread"], default="process",
+                        help="run each VM in its own process (default) or as a thread of this process")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.mode == "process" and sys.platform.startswith("linux"):
+        # fork starts each VM without re-importing main and vm in the child, as spawn would.
+        # Only on Linux: macOS defaults to spawn because fork is unsafe there.
+        multiprocessing.set_start_method("fork", force=True)
+    disable_unused_log_fields()
+    configure_logging()
     logger.info("Starting Lamport Clock Simulation")
     signal.signal(signal.SIGINT, signal_handler)
-    vms = setup_vms(num_vms=3)
-    run_vms(vms)
+    num_vms = 3
+    buffer_pool = None
+    if args.mode == "thread":
+        # VMs sharing this process can share one pool: one buffer per peer connection.
+        buffer_pool = make_buffer_pool(num_vms * (num_vms - 1))
+    vms = setup_vms(num_vms=num_vms, buffer_pool=buffer_pool)
+    run_vms(vms, mode=args.mode)
+    # Only now start the listener thread, so process-mode VMs are forked from a single-threaded parent
+    start_logging()
     logger.info("All VMs are running. Press Ctrl+C to stop.")
-    try:
-        # Keep the main process running
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        stop_vms(vms)
+    # Block without periodic wakeups until signal_handler sets the event.
+    stop_event.wait()
+    logger.info("Shutting down all virtual machines...")
+    stop_vms(vms)
+    logger.info("Shutdown complete. Exiting.")
+    stop_logging()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,51 +1,60 @@
+import os
+import numpy as np
 import pandas as pd
+import matplotlib
+# Non-interactive backend for batch/CI runs; must be selected before pyplot is imported.
+HEADLESS = bool(os.environ.get("HEADLESS"))
+if HEADLESS:
+    matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import re
-from datetime import datetime
 import glob
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+CHUNK_LINES = 100_000  # Lines parsed per batch in parse_log_file
+
+# Logical clock and queue length are captured in the same match pass as the rest of the line.
+# Every field is anchored on a literal delimiter (no ".*?" scans), so matching never backtracks.
+# Logs from older runs also carry a "System time" field; current logs rely on the logger timestamp.
+_LOG_RE = re.compile(
+    r'^(?P<log_ts>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (?P<event>[^,]+), '
+    r'(?:System time: (?P<sys_time>[\d\- :.]+), )?(?:Queue length: (?P<q_len>\d+), )?(?:Logical clock: (?P<lc>\d+))?'
+)
+
+def _parse_lines(lines):
+    # Parse one batch of raw log lines in a single vectorized pass (no per-line Python loop).
+    matches = pd.Series(lines, dtype=object).str.extract(_LOG_RE).dropna(subset=["log_ts"])
+    # str(datetime) omits the fraction when it is zero; pad so one fixed format parses every row.
+    sys_time = matches["sys_time"].str.strip()
+    sys_time = sys_time.where(sys_time.str.len() > 19, sys_time + ".000000")
+    log_ts = pd.to_datetime(matches["log_ts"], format="%Y-%m-%d %H:%M:%S,%f", cache=True).astype("datetime64[ns]")
+    system_time = pd.to_datetime(sys_time, format="%Y-%m-%d %H:%M:%S.%f", cache=True).astype("datetime64[ns]")
+    return pd.DataFrame({
+        "log_ts": log_ts,
+        "system_time": system_time.fillna(log_ts),
+        "event": matches["event"].str.strip(),
+        "logical_clock": pd.to_numeric(matches["lc"]),
+        "queue_length": pd.to_numeric(matches["q_len"])
+    })
 
 def parse_log_file(filename):
-    # Parse log files for relevant information
-    data = []
-    pattern = re.compile(
-        r'^(?P<log_ts>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (?P<event>[^,]+), System time: (?P<sys_time>[\d\- :.]+), (?P<details>.*)$'
-    )
-    with open(filename, 'r') as f:
-        for line in f:
-            line = line.strip()
-            m = pattern.match(line)
-            if m:
-                log_ts_str = m.group("log_ts")
-                log_ts = datetime.strptime(log_ts_str, "%Y-%m-%d %H:%M:%S,%f")
-                event = m.group("event").strip()
-                sys_time_str = m.group("sys_time").strip()
-                sys_time = datetime.strptime(sys_time_str, "%Y-%m-%d %H:%M:%S.%f")
-                details = m.group("details")
-                # Extract logical clock value.
-                lc = None
-                lc_match = re.search(r'Logical clock:\s*(\d+)', details)
-                if lc_match:
-                    lc = int(lc_match.group(1))
-                # Extract queue length if present.
-                q_len = None
-                q_match = re.search(r'Queue length:\s*(\d+)', details)
-                if q_match:
-                    q_len = int(q_match.group(1))
-                data.append({
-                    "log_ts": log_ts,
-                    "system_time": sys_time,
-                    "event": event,
-                    "logical_clock": lc,
-                    "queue_length": q_len
-                })
-    df = pd.DataFrame(data)
-    df.sort_values(by="system_time", inplace=True)
+    # Parse log files for relevant information, CHUNK_LINES lines at a time so that
+    # only one batch of raw text is held in memory alongside the parsed rows.
+    with open(filename, 'r', buffering=1 << 20) as f:
+        chunks = [_parse_lines(batch) for batch in iter(lambda: list(islice(f, CHUNK_LINES)), [])]
+    df = pd.concat(chunks, ignore_index=True) if chunks else _parse_lines([])
+    df["event"] = df["event"].astype("category")
     return df
 
 def parse_all_logs(filenames):
     dfs = []
-    for fname in filenames:
-        df = parse_log_file(fname)
+    # Parsing is CPU-bound and independent per file, so parse the logs in parallel.
+    # One worker per file at most: the pool may launch all its workers up front.
+    workers = max(1, min(len(filenames), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(parse_log_file, filenames, chunksize=1))
+    for fname, df in zip(filenames, parsed):
         # Extract VM id from the filename (assumes filenames like "vm_1.log")
         parts = fname.split("_")
         if len(parts) > 1:
@@ -55,57 +64,64 @@ def parse_all_logs(filenames):
         df["vm_id"] = vm_id
         dfs.append(df)
     combined_df = pd.concat(dfs, ignore_index=True)
+    # concat falls back to object dtype when the per-file categories differ, so recast here.
+    combined_df["event"] = combined_df["event"].astype("category")
+    combined_df["vm_id"] = combined_df["vm_id"].astype("category")
+    # Sort once here; parse_log_file leaves rows in file order.
     combined_df.sort_values(by="system_time", inplace=True)
     return combined_df
 
 def plot_queue_sizes(df):
     # Plot queue length over time for each VM
-    plt.figure(figsize=(12, 6))
-    for vm_id, group in df.groupby("vm_id"):
-        df_receive = group[group["event"].str.upper() == "RECEIVE"]
-        plt.plot(df_receive["system_time"], df_receive["queue_length"],
-                 marker='o', linestyle='-', label=f"VM {vm_id}")
+    plt.rcParams['path.simplify'] = True
+    plt.rcParams['path.simplify_threshold'] = 1.0
+    fig, ax = plt.subplots(figsize=(12, 6))
+    receive_df = df[df["event"] == "RECEIVE"]
+    for vm_id, df_receive in receive_df.groupby("vm_id", observed=True):
+        x = df_receive["system_time"].to_numpy()
+        y = df_receive["queue_length"].to_numpy()
+        line, = ax.plot(x, y, '-', label=f"VM {vm_id}")
+        # Draw markers for at most ~200 points per VM; per-point markers dominate render time.
+        step = max(1, len(x) // 200)
+        ax.plot(x[::step], y[::step], 'o', color=line.get_color())
     plt.xlabel("System Time")
     plt.ylabel("Queue Length")
     plt.title("Queue Length Over Time (All VMs)")
     plt.xticks(rotation=45)
     plt.legend()
     plt.tight_layout()
-    plt.show()
+    if HEADLESS:
+        plt.savefig("queue_sizes.png", dpi=120)
+        plt.close(fig)
+    else:
+        plt.show()
 
 def compute_jump_stats(df):
-    # Compute jump statistics for logical clock updates
-    stats = {}
-    for vm_id, group in df.groupby("vm_id"):
-        group = group.dropna(subset=["logical_clock"]).sort_values(by="system_time")
-        group["jump"] = group["logical_clock"].diff()
-        stats[vm_id] = group["jump"].describe()
-    return stats
+    # Compute jump statistics for logical clock updates (one row per VM)
+    valid = df.dropna(subset=["logical_clock"]).sort_values(by=["vm_id", "system_time"])
+    vm_ids = valid["vm_id"].to_numpy()
+    jumps = np.diff(valid["logical_clock"].to_numpy(dtype=float), prepend=np.nan)
+    # Rows are grouped by VM, so a jump across a VM boundary is not a jump; mask it out.
+    jumps[1:][vm_ids[1:] != vm_ids[:-1]] = np.nan
+    return pd.Series(jumps, index=valid.index).groupby(valid["vm_id"], observed=True).describe()
 
 def compute_drift(df):
-    drift_results = {}
-    for vm_id, group in df.groupby("vm_id"):
-        group = group.dropna(subset=["logical_clock"]).sort_values(by="system_time")
-        if not group.empty:
-            start_time = group["system_time"].iloc[0]
-            end_time = group["system_time"].iloc[-1]
-            elapsed_seconds = (end_time - start_time).total_seconds()
-            final_lc = group["logical_clock"].iloc[-1]
-            drift = final_lc - elapsed_seconds
-            drift_results[vm_id] = {
-                "final_logical_clock": final_lc,
-                "elapsed_seconds": elapsed_seconds,
-                "drift": drift
-            }
-    return drift_results
+    valid = df.dropna(subset=["logical_clock"]).sort_values(by=["vm_id", "system_time"])
+    g = valid.groupby("vm_id", observed=True)
+    # Subtract raw int64 nanoseconds rather than building Timedelta objects.
+    first_ns = g["system_time"].first().astype("int64")
+    last_ns = g["system_time"].last().astype("int64")
+    final_lc = g["logical_clock"].last()
+    elapsed_seconds = (last_ns - first_ns) / 1e9
+    drift_df = pd.DataFrame({
+        "final_logical_clock": final_lc,
+        "elapsed_seconds": elapsed_seconds,
+        "drift": final_lc - elapsed_seconds
+    })
+    return drift_df.to_dict("index")
 
 def print_jump_stats_table(jump_stats):
-    summary_list = []
-    for vm_id, stats in jump_stats.items():
-        temp = stats.to_dict()
-        temp["vm_id"] = vm_id
-        summary_list.append(temp)
-    summary_df = pd.DataFrame(summary_list)
+    summary_df = jump_stats.reset_index()
     return summary_df
 
 if __name__ == '__main__':
@@ -121,7 +137,7 @@ if __name__ == '__main__':
     # Compute and display jump statistics for the logical clock
     jump_stats = compute_jump_stats(df_all)
     print("Jump Statistics by VM:")
-    for vm_id, stats in jump_stats.items():
+    for vm_id, stats in jump_stats.iterrows():
         print(f"VM {vm_id}:")
         print(stats)
         print()
@@ -1,18 +1,49 @@
 import unittest
-from unittest.mock import patch, MagicMock, call
+import collections
+import copy
+from unittest.mock import patch, MagicMock, DEFAULT, call
 import socket
-import threading
-import time
 import queue
+import logging
+import re
 import os
-import tempfile
 import gzip
-import logging
-import multiprocessing
-from datetime import datetime
+import tempfile
+import selectors
+import threading
 
 # Import the modules to test
-from vm import VirtualMachine
+from vm import VirtualMachine, CachedTimeFormatter, BUFFER_SIZE, CLOCK_FRAME
+from main import setup_vms, run_vms, stop_vms, parse_args, virtual_machines, vm_threads
+
+# Fail loudly on any real outbound connection (like pytest-socket's --disable-socket);
+# tests that exercise connections patch socket.socket with mocks instead.
+def _refuse_connection(sock, address):
+    raise RuntimeError("Real network access is disabled in tests")
+
+# A plain function rather than a mock, so patch('socket.socket', autospec=True) can still spec it
+_network_guard = patch.object(socket.socket, 'connect', _refuse_connection)
+
+class ListHandler(logging.Handler):
+    """In-memory replacement for the VM's rotating file handler."""
+    
+    def __init__(self, *args, **kwargs):
+        logging.Handler.__init__(self)
+        self.records = []
+    
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+def logged_message(log_method):
+    """Render the message of the last call to a mocked logger method, as logging would."""
+    msg, *args = log_method.call_args[0]
+    return msg % tuple(args)
+
+def setUpModule():
+    _network_guard.start()
+
+def tearDownModule():
+    _network_guard.stop()
 
 class TestVirtualMachineInitialization(unittest.TestCase):
     """Tests for VirtualMachine initialization."""
@@ -41,11 +72,46 @@ class TestVirtualMachineInitialization(unittest.TestCase):
                 mock_handler.assert_called_once()
                 mock_logger.addHandler.assert_called_once()
     
+    def test_log_rotation_compresses_in_background(self):
+        """Test the rotator hands the rotated file to the gzip worker and leaves only the .gz."""
+        with tempfile.TemporaryDirectory() as tmp, \
+             patch('logging.handlers.TimedRotatingFileHandler') as mock_handler:
+            vm = VirtualMachine(id=1, port=10001, peer_ports=[], clock_rate=1)
+            vm._init_logger()
+            vm.logger.removeHandler(vm.log_buffer)
+            
+            source, dest = os.path.join(tmp, "vm_1.log"), os.path.join(tmp, "vm_1.log.gz")
+            with open(source, "wb") as f:
+                f.write(b"INTERNAL, Logical clock: 1\n")
+            mock_handler.return_value.rotator(source, dest)
+            vm.gzip_pool.shutdown(wait=True)
+            
+            self.assertEqual(os.listdir(tmp), ["vm_1.log.gz"])
+            with gzip.open(dest, "rb") as f:
+                self.assertEqual(f.read(), b"INTERNAL, Logical clock: 1\n")
+            
+            # A rollover after stop() has shut the pool down is compressed in place
+            late_dest = os.path.join(tmp, "vm_1.log.late.gz")
+            with open(source, "wb") as f:
+                f.write(b"Error handling client: reset\n")
+            mock_handler.return_value.rotator(source, late_dest)
+            
+            self.assertEqual(sorted(os.listdir(tmp)), ["vm_1.log.gz", "vm_1.log.late.gz"])
+            with gzip.open(late_dest, "rb") as f:
+                self.assertEqual(f.read(), b"Error handling client: reset\n")
+    
+    def test_log_timestamp_format(self):
+        """Test the cached asctime matches logging's default, including across a second boundary."""
+        fmt = '%(asctime)s - %(message)s'
+        cached, default = CachedTimeFormatter(fmt), logging.Formatter(fmt)
+        for created in (1700000000.001, 1700000000.999, 1700000001.5):
+            record = logging.makeLogRecord({"msg": "INTERNAL", "created": created, "msecs": (created % 1) * 1000})
+            self.assertEqual(cached.format(record), default.format(record))
+    
     def test_socket_initialization(self):
         """Test server socket binding and listening setup."""
-        with patch('socket.socket') as mock_socket:
-            mock_instance = MagicMock()
-            mock_socket.return_value = mock_instance
+        with patch('socket.socket', autospec=True) as mock_socket:
+            mock_instance = mock_socket.return_value
             
             vm = VirtualMachine(id=1, port=10001, peer_ports=[], clock_rate=1)
             vm._init_server_socket()
@@ -58,8 +124,14 @@ class TestVirtualMachineInitialization(unittest.TestCase):
 class TestLogicalClockOperations(unittest.TestCase):
     """Tests for logical clock operations."""
     
+    @classmethod
+    def setUpClass(cls):
+        # Construct once; each test works on a shallow copy with fresh mutable state
+        cls.vm_template = VirtualMachine(id=1, port=10001, peer_ports=[], clock_rate=1)
+    
     def setUp(self):
-        self.vm = VirtualMachine(id=1, port=10001, peer_ports=[], clock_rate=1)
+        self.vm = copy.copy(self.vm_template)
+        self.vm.logical_clock = 0
         self.vm.logger = MagicMock()
     
     def test_internal_clock_update(self):
@@ -89,7 +161,7 @@ class TestLogicalClockOperations(unittest.TestCase):
         self.vm.internal_event()
         self.assertEqual(self.vm.logical_clock, 8)
         self.vm.logger.info.assert_called_once()
-        log_msg = self.vm.logger.info.call_args[0][0]
+        log_msg = logged_message(self.vm.logger.info)
         self.assertIn("INTERNAL", log_msg)
         self.assertIn("Logical clock: 8", log_msg)
 
@@ -97,51 +169,80 @@ class TestLogicalClockOperations(unittest.TestCase):
 class TestMessageHandling(unittest.TestCase):
     """Tests for message sending and receiving."""
     
+    @classmethod
+    def setUpClass(cls):
+        cls.vm_template = VirtualMachine(id=1, port=10001, peer_ports=[10002, 10003], clock_rate=1)
+    
     def setUp(self):
-        self.vm = VirtualMachine(id=1, port=10001, peer_ports=[10002, 10003], clock_rate=1)
+        self.vm = copy.copy(self.vm_template)
+        self.vm.logical_clock = 0
         self.vm.logger = MagicMock()
-        self.vm.message_queue = queue.Queue()
-        self.vm.peer_connections = {}
+        self.vm.message_queue = collections.deque()
+        self.vm.buffer_pool = queue.Queue()
+        self.vm.peer_sockets = [None, None]
         self.vm.running = True
     
     def test_send_message_success(self):
         """Test successful message sending to a peer."""
         mock_socket = MagicMock()
-        self.vm.peer_connections[10002] = mock_socket
+        self.vm.peer_sockets[0] = mock_socket
         
         self.vm.logical_clock = 5
-        self.vm.send_message(10002)
+        self.vm.send_message(0)
         
         # Clock should increment
         self.assertEqual(self.vm.logical_clock, 6)
         
         # Socket should send the clock value
-        mock_socket.send.assert_called_once_with(b"6")
+        mock_socket.sendall.assert_called_once_with(CLOCK_FRAME.pack(6))
         
         # Action should be logged
         self.vm.logger.info.assert_called_once()
-        log_msg = self.vm.logger.info.call_args[0][0]
-        self.assertIn("SEND", log_msg)
+        log_msg = logged_message(self.vm.logger.info)
+        self.assertIn("SEND to 10002", log_msg)
         self.assertIn("Logical clock: 6", log_msg)
     
     def test_send_message_error(self):
         """Test error handling during message sending."""
         mock_socket = MagicMock()
-        mock_socket.send.side_effect = Exception("Connection failed")
-        self.vm.peer_connections[10002] = mock_socket
+        mock_socket.sendall.side_effect = Exception("Connection failed")
+        self.vm.peer_sockets[0] = mock_socket
         
-        self.vm.send_message(10002)
+        self.vm.send_message(0)
         
         # Error should be logged
         self.vm.logger.error.assert_called_once()
         
         # Connection should be removed
-        self.assertNotIn(10002, self.vm.peer_connections)
+        self.assertIsNone(self.vm.peer_sockets[0])
+    
+    def test_broadcast_message(self):
+        """Test a broadcast ticks the clock once and sends the same value to every peer."""
+        sockets = [MagicMock(), MagicMock()]
+        self.vm.peer_sockets = sockets
+        
+        self.vm.logical_clock = 5
+        self.vm.broadcast_message()
+        
+        # One event, one tick
+        self.assertEqual(self.vm.logical_clock, 6)
+        for mock_socket in sockets:
+            mock_socket.sendall.assert_called_once_with(CLOCK_FRAME.pack(6))
+        
+        # Each send is still logged
+        self.assertEqual(self.vm.logger.info.call_count, 2)
+        
+        # With every peer disconnected nothing is sent, so the clock must not move
+        self.vm.peer_sockets = [None, None]
+        self.vm.broadcast_message()
+        self.assertEqual(self.vm.logical_clock, 6)
+        self.assertEqual(self.vm.logger.info.call_count, 2)
+        self.assertEqual(self.vm.logger.error.call_count, 2)
     
     def test_process_message_from_queue(self):
         """Test processing messages from the queue."""
         # Add a message to the queue
-        self.vm.message_queue.put(15)
+        self.vm.message_queue.append(15)
         
         # Process the message
         result = self.vm.process_message()
@@ -154,7 +255,7 @@ class TestMessageHandling(unittest.TestCase):
         
         # Action should be logged
         self.vm.logger.info.assert_called_once()
-        log_msg = self.vm.logger.info.call_args[0][0]
+        log_msg = logged_message(self.vm.logger.info)
         self.assertIn("RECEIVE", log_msg)
         self.assertIn("Queue length: 0", log_msg)
         self.assertIn("Logical clock: 16", log_msg)
@@ -162,39 +263,52 @@ class TestMessageHandling(unittest.TestCase):
     def test_handle_client_message(self):
         """Test handling messages from connected clients."""
         mock_socket = MagicMock()
-        # Simulate receiving two messages then closing
-        mock_socket.recv.side_effect = [b"10", b"20", b""]
-        
-        # Handle the client in a separate thread
-        client_thread = threading.Thread(target=self.vm.handle_client, args=(mock_socket,))
-        client_thread.daemon = True
-        client_thread.start()
-        
-        # Give time for messages to process
-        time.sleep(0.1)
-        self.vm.running = False
-        client_thread.join(timeout=1)
+        self.vm.selector = MagicMock()
+        self.vm.client_buffers = {mock_socket: [bytearray(BUFFER_SIZE), 0]}
+        # Simulate receiving two messages, the second split across reads, then closing
+        stream = CLOCK_FRAME.pack(10) + CLOCK_FRAME.pack(20)
+        chunks = [stream[:6], stream[6:], b""]
+        def fake_recv_into(buf):
+            chunk = chunks.pop(0)
+            buf[:len(chunk)] = chunk
+            return len(chunk)
+        mock_socket.recv_into.side_effect = fake_recv_into
+        
+        # The selector calls the handler once per readable event
+        for _ in range(3):
+            self.vm.handle_client(mock_socket)
+        
+        # The empty read closes the connection
+        self.vm.selector.unregister.assert_called_once_with(mock_socket)
+        mock_socket.close.assert_called_once()
         
         # Check messages were added to queue
-        self.assertEqual(self.vm.message_queue.qsize(), 2)
-        self.assertEqual(self.vm.message_queue.get(), 10)
-        self.assertEqual(self.vm.message_queue.get(), 20)
+        self.assertEqual(len(self.vm.message_queue), 2)
+        self.assertEqual(self.vm.message_queue.popleft(), 10)
+        self.assertEqual(self.vm.message_queue.popleft(), 20)
+        
+        # Receive buffer should be returned to the pool
+        self.assertEqual(self.vm.buffer_pool.qsize(), 1)
+        self.assertEqual(self.vm.client_buffers, {})
 
 
 class TestConnectionManagement(unittest.TestCase):
     """Tests for connection establishment and management."""
     
+    @classmethod
+    def setUpClass(cls):
+        cls.vm_template = VirtualMachine(id=1, port=10001, peer_ports=[10002, 10003], clock_rate=1)
+    
     def setUp(self):
-        self.vm = VirtualMachine(id=1, port=10001, peer_ports=[10002, 10003], clock_rate=1)
+        self.vm = copy.copy(self.vm_template)
         self.vm.logger = MagicMock()
         self.vm.running = True
-        self.vm.peer_connections = {}
+        self.vm.peer_sockets = [None, None]
     
     def test_connect_to_peers_success(self):
         """Test successful connection to peers."""
-        with patch('socket.socket') as mock_socket:
-            mock_instance = MagicMock()
-            mock_socket.return_value = mock_instance
+        with patch('socket.socket', autospec=True) as mock_socket:
+            mock_instance = mock_socket.return_value
             
             self.vm.connect_to_peers()
             
@@ -205,122 +319,176 @@ class TestConnectionManagement(unittest.TestCase):
                 call(('localhost', 10003))
             ], any_order=True)
             
-            # Should store connections
-            self.assertEqual(len(self.vm.peer_connections), 2)
-            self.assertIn(10002, self.vm.peer_connections)
-            self.assertIn(10003, self.vm.peer_connections)
+            # Should disable Nagle on each connection
+            mock_instance.setsockopt.assert_called_with(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            
+            # Should store a connection for each peer
+            self.assertEqual(self.vm.peer_sockets, [mock_instance, mock_instance])
     
     def test_connect_to_peers_retry(self):
         """Test retrying failed connections to peers."""
-        with patch('socket.socket') as mock_socket, patch('time.sleep') as mock_sleep:
-            mock_instance = MagicMock()
+        with patch('socket.socket', autospec=True) as mock_socket, patch('time.sleep') as mock_sleep:
+            mock_instance = mock_socket.return_value
             # First connection attempt fails, second succeeds
             connect_side_effects = [Exception("Connection refused"), None]
             mock_instance.connect.side_effect = connect_side_effects
-            mock_socket.return_value = mock_instance
             
             # Only test with one peer for simplicity
             self.vm.peer_ports = [10002]
+            self.vm.peer_sockets = [None]
             self.vm.connect_to_peers()
             
             # Should retry once after failure
             self.assertEqual(mock_instance.connect.call_count, 2)
             
             # Should have one connection after retry success
-            self.assertEqual(len(self.vm.peer_connections), 1)
-            self.assertIn(10002, self.vm.peer_connections)
+            self.assertEqual(self.vm.peer_sockets, [mock_instance])
             
             # Should log error for first attempt
             self.vm.logger.error.assert_called_once()
+            
+            # Should back off briefly (first step plus jitter) rather than a full second
+            mock_sleep.assert_called_once()
+            self.assertLess(mock_sleep.call_args[0][0], 0.1)
     
-    def test_accept_connections_handling(self):
-        """Test server socket accepting connections."""
-        self.vm.server_socket = MagicMock()
+    def test_accept_connection_handling(self):
+        """Test accepting a peer connection registers it with the selector."""
+        server_socket = MagicMock()
         mock_client = MagicMock()
+        server_socket.accept.return_value = (mock_client, ('127.0.0.1', 10099))
+        self.vm.selector = MagicMock()
+        self.vm.client_buffers = {}
+        self.vm.buffer_pool = queue.Queue()
+        
+        self.vm.accept_connection(server_socket)
+        
+        # The client is read without blocking, from the selector thread
+        mock_client.setblocking.assert_called_once_with(False)
+        mock_client.setsockopt.assert_called_once_with(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.vm.selector.register.assert_called_once_with(
+            mock_client, selectors.EVENT_READ, self.vm.handle_client)
+        buf, filled = self.vm.client_buffers[mock_client]
+        self.assertEqual((len(buf), filled), (BUFFER_SIZE, 0))
+    
+    def test_serve_connections_dispatch(self):
+        """Test the selector loop hands each ready socket to its callback."""
+        callback = MagicMock()
+        key = MagicMock(fileobj="sock", data=callback)
+        self.vm.selector = MagicMock()
+        self.vm.client_buffers = {}
+        self.vm.wakeup_reader = MagicMock()
+        self.vm.wakeup_writer = MagicMock()
+        
+        # Report one ready socket, then stop
+        def fake_select(timeout=None):
+            self.vm.running = False
+            return [(key, selectors.EVENT_READ)]
+        self.vm.selector.select.side_effect = fake_select
         
-        # Socket accepts one connection then times out
-        self.vm.server_socket.accept.side_effect = [
-            (mock_client, ('127.0.0.1', 10099)),
-            socket.timeout()
-        ]
+        self.vm.serve_connections()
         
-        # Run accept_connections in a separate thread
-        with patch('threading.Thread') as mock_thread:
-            # Make function exit after handling both events
-            def side_effect(*args, **kwargs):
-                self.vm.running = False
-                return MagicMock()
-            mock_thread.side_effect = side_effect
-            
-            self.vm.accept_connections()
-            
-            # Should try to start a client handler thread
-            mock_thread.assert_called_once()
-            # First arg should be handle_client
-            self.assertEqual(mock_thread.call_args[1]['target'], self.vm.handle_client)
+        callback.assert_called_once_with("sock")
+        self.vm.selector.close.assert_called_once()
 
 
 class TestVMLifecycle(unittest.TestCase):
     """Tests for the VM lifecycle (start, run, stop)."""
     
+    @classmethod
+    def setUpClass(cls):
+        cls.vm_template = VirtualMachine(id=1, port=10001, peer_ports=[10002], clock_rate=1)
+    
     def setUp(self):
-        self.vm = VirtualMachine(id=1, port=10001, peer_ports=[10002], clock_rate=1)
+        self.vm = copy.copy(self.vm_template)
+        self.vm.logical_clock = 0
+        self.vm.running = False
         self.vm.logger = MagicMock()
+        self.vm.log_buffer = MagicMock()
     
+    @patch('socket.socketpair', return_value=(MagicMock(), MagicMock()))
+    @patch('selectors.DefaultSelector')
     @patch('threading.Thread')
-    def test_start_server(self, mock_thread):
+    def test_start_server(self, mock_thread, mock_selector, mock_socketpair):
         """Test starting the server thread."""
         mock_thread_instance = MagicMock()
         mock_thread.return_value = mock_thread_instance
+        self.vm.server_socket = MagicMock()
         
         self.vm.start_server()
         
-        # Should create thread with accept_connections
-        mock_thread.assert_called_once_with(target=self.vm.accept_connections)
+        # Should watch the listening socket for new connections
+        mock_selector.return_value.register.assert_any_call(
+            self.vm.server_socket, selectors.EVENT_READ, self.vm.accept_connection)
+        # Should watch the wakeup socket that stop() writes to
+        mock_selector.return_value.register.assert_any_call(
+            self.vm.wakeup_reader, selectors.EVENT_READ, self.vm._drain_wakeup)
+        # Should create thread with serve_connections
+        mock_thread.assert_called_once_with(target=self.vm.serve_connections)
         # Should set thread as daemon
         self.assertTrue(mock_thread_instance.daemon)
         # Should start thread
         mock_thread_instance.start.assert_called_once()
     
-    @patch.multiple(VirtualMachine, 
-                  _init_logger=MagicMock(),
-                  _init_server_socket=MagicMock(),
-                  start_server=MagicMock(),
-                  connect_to_peers=MagicMock(),
-                  process_message=MagicMock(return_value=False),
-                  send_message=MagicMock(),
-                  internal_event=MagicMock())
     def test_run_decision_logic(self):
         """Test the main loop action decision logic."""
+        self.vm.peer_ports = [10002, 10003]
+        
         # Make VM stop after one iteration
         def stop_after_one(*args, **kwargs):
             self.vm.running = False
             return False
         
-        self.vm.process_message.side_effect = stop_after_one
-        
-        # Test different random outcomes
+        # Each random outcome is checked as its own sub-test
         test_cases = [
-            (1, "send_to_first_peer"),   # action == 1: send to first peer
-            (2, "send_to_second_peer"),  # action == 2: send to second peer
-            (3, "send_to_all_peers"),    # action == 3: send to all peers
-            (4, "internal_event")        # action > 3: internal event
+            (0, "send_message", [call(0)]),      # draw 0: send to first peer
+            (1, "send_message", [call(1)]),      # draw 1: send to second peer
+            (2, "broadcast_message", [call()]),  # draw 2: send to all peers
+            (3, "internal_event", [call()])      # draws 3-9: internal event
         ]
         
-        for random_value, expected_action in test_cases:
-            with patch('random.randint', return_value=random_value):
-                with patch('time.sleep'):
-                    self.vm.running = True
-                    self.vm.run()
-                    
-                    # Reset all mocks for next iteration
-                    self.vm._init_logger.reset_mock()
-                    self.vm._init_server_socket.reset_mock()
-                    self.vm.start_server.reset_mock()
-                    self.vm.connect_to_peers.reset_mock()
-                    self.vm.process_message.reset_mock()
-                    self.vm.send_message.reset_mock()
-                    self.vm.internal_event.reset_mock()
+        for random_value, expected_event, expected_calls in test_cases:
+            # Fresh mocks per case, so nothing needs resetting between cases
+            with self.subTest(action=random_value), \
+                 patch.multiple(VirtualMachine,
+                                _init_logger=DEFAULT,
+                                _init_server_socket=DEFAULT,
+                                start_server=DEFAULT,
+                                connect_to_peers=DEFAULT,
+                                process_message=DEFAULT,
+                                send_message=DEFAULT,
+                                broadcast_message=DEFAULT,
+                                internal_event=DEFAULT) as mocks, \
+                 patch('random.random', return_value=random_value / 10 + 0.05), \
+                 patch('time.sleep'):
+                mocks["process_message"].side_effect = stop_after_one
+                self.vm.run()
+                
+                # Only the drawn event runs
+                for event in ("send_message", "broadcast_message", "internal_event"):
+                    expected = expected_calls if event == expected_event else []
+                    self.assertEqual(mocks[event].call_args_list, expected)
+    
+    def test_run_loop_ticks(self):
+        """Test the real run loop advances the clock once per tick without real sleeping."""
+        sleeps = []
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 5:
+                self.vm.running = False
+        
+        with patch.multiple(VirtualMachine,
+                            _init_logger=MagicMock(),
+                            _init_server_socket=MagicMock(),
+                            start_server=MagicMock(),
+                            connect_to_peers=MagicMock()):
+            with patch('random.random', return_value=0.95), patch('time.sleep', side_effect=fake_sleep):
+                self.vm.running = True
+                self.vm.run()
+        
+        # One start-up sleep, then one sleep per tick: four ticks, four internal events
+        self.assertEqual(len(sleeps), 5)
+        self.assertEqual(self.vm.logical_clock, 4)
+        self.assertEqual(self.vm.logger.info.call_count, 4)
     
     def test_stop(self):
         """Test stopping the VM and cleaning up resources."""
@@ -329,11 +497,9 @@ class TestVMLifecycle(unittest.TestCase):
         mock_socket2 = MagicMock()
         mock_server = MagicMock()
         
-        self.vm.peer_connections = {
-            10002: mock_socket1,
-            10003: mock_socket2
-        }
+        self.vm.peer_sockets = [mock_socket1, mock_socket2]
         self.vm.server_socket = mock_server
+        self.vm.wakeup_writer = MagicMock()
         self.vm.running = True
         
         # Stop the VM
@@ -348,29 +514,28 @@ class TestVMLifecycle(unittest.TestCase):
         
         # Server socket should be closed
         mock_server.close.assert_called_once()
+        
+        # The selector thread should be woken so it can exit
+        self.vm.wakeup_writer.send.assert_called_once()
 
 
 class TestIntegrationSingleVM(unittest.TestCase):
     """Integration tests for a single VM with mocked networking."""
     
     def setUp(self):
-        # Create a temporary directory for logs
-        self.test_dir = tempfile.mkdtemp()
-        os.chdir(self.test_dir)
-        
-        # Setup VM with mock network
+        # Setup VM with mock network; log records are kept in memory instead of vm_1.log
         self.vm = VirtualMachine(id=1, port=10001, peer_ports=[10002], clock_rate=5)
-        self.vm.message_queue = queue.Queue()
-        self.vm.peer_connections = {}
-        self.vm._init_logger()
+        self.vm.message_queue = collections.deque()
+        self.vm.peer_sockets = [None]
+        self.handler = ListHandler()
+        with patch('logging.handlers.TimedRotatingFileHandler', return_value=self.handler):
+            self.vm._init_logger()
         self.vm.server_socket = MagicMock()
         self.vm.running = True
     
     def tearDown(self):
-        # Clean up temporary files
-        for file in os.listdir(self.test_dir):
-            os.remove(os.path.join(self.test_dir, file))
-        os.rmdir(self.test_dir)
+        # VM loggers are process-wide, so detach this test's handler
+        self.vm.logger.removeHandler(self.vm.log_buffer)
     
     def test_clock_consistency(self):
         """Test logical clock maintains consistency across operations."""
@@ -382,8 +547,8 @@ class TestIntegrationSingleVM(unittest.TestCase):
         self.assertEqual(self.vm.logical_clock, 1)
         
         # Add messages to queue with different timestamps
-        self.vm.message_queue.put(5)  # Higher than current
-        self.vm.message_queue.put(2)  # Lower than current after processing
+        self.vm.message_queue.append(5)  # Higher than current
+        self.vm.message_queue.append(2)  # Lower than current after processing
         
         # Process first message - should jump to 6
         self.vm.process_message()
@@ -395,12 +560,12 @@ class TestIntegrationSingleVM(unittest.TestCase):
         
         # Set up mock socket for sending
         mock_socket = MagicMock()
-        self.vm.peer_connections[10002] = mock_socket
+        self.vm.peer_sockets[0] = mock_socket
         
         # Send message - should increment to 8
-        self.vm.send_message(10002)
+        self.vm.send_message(0)
         self.assertEqual(self.vm.logical_clock, 8)
-        mock_socket.send.assert_called_once_with(b"8")
+        mock_socket.sendall.assert_called_once_with(CLOCK_FRAME.pack(8))
     
     def test_event_logging(self):
         """Test that all events are properly logged."""
@@ -408,93 +573,113 @@ class TestIntegrationSingleVM(unittest.TestCase):
         self.vm.internal_event()  # Clock = 1
         
         # Add and process message
-        self.vm.message_queue.put(10)
+        self.vm.message_queue.append(10)
         self.vm.process_message()  # Clock = 11
         
         # Set up mock socket for sending
         mock_socket = MagicMock()
-        self.vm.peer_connections[10002] = mock_socket
+        self.vm.peer_sockets[0] = mock_socket
         
         # Send message
-        self.vm.send_message(10002)  # Clock = 12
+        self.vm.send_message(0)  # Clock = 12
         
         # Stop VM
         self.vm.stop()
         
-        # Check log file exists and contains expected events
-        log_file = f"vm_{self.vm.id}.log"
-        self.assertTrue(os.path.exists(log_file))
+        # Check the captured log output contains expected events
+        content = "\n".join(self.handler.records)
         
-        with open(log_file, 'r') as f:
-            content = f.read()
+        # Collect event types and clock values in a single pass over the log
+        pattern = re.compile(r"\b(INTERNAL|RECEIVE|SEND)\b|Logical clock: (\d+)")
+        found = {event or clock for event, clock in pattern.findall(content)}
         
-        # Verify all event types are logged
-        self.assertIn("INTERNAL", content)
-        self.assertIn("RECEIVE", content)
-        self.assertIn("SEND", content)
-        
-        # Verify correct clock values
-        self.assertIn("Logical clock: 1", content)
-        self.assertIn("Logical clock: 11", content)
-        self.assertIn("Logical clock: 12", content)
+        # Verify all event types are logged with the correct clock values
+        self.assertEqual(found, {"INTERNAL", "RECEIVE", "SEND", "1", "11", "12"})
 
 
 class TestMultiVMSystem(unittest.TestCase):
     """System test for multiple VMs."""
     
-    def setUp(self):
-        # Ensure multiprocessing uses 'spawn' for consistency
-        try:
-            multiprocessing.set_start_method('spawn', force=True)
-        except RuntimeError:
-            pass  # Already set
-        
-        # Create temp directory
-        self.test_dir = tempfile.mkdtemp()
-        os.chdir(self.test_dir)
+    @classmethod
+    def setUpClass(cls):
+        # Build the VMs once; the tests only read their configuration or mock their lifecycle
+        virtual_machines.clear()
+        cls.vms = setup_vms(num_vms=3, base_port=10010)
     
-    def tearDown(self):
-        # Clean up temporary files
-        for file in os.listdir(self.test_dir):
-            try:
-                os.remove(os.path.join(self.test_dir, file))
-            except:
-                pass
-        os.rmdir(self.test_dir)
+    @classmethod
+    def tearDownClass(cls):
+        virtual_machines.clear()
+    
+    def test_simulation_setup(self):
+        """Test simulation setup with multiple VMs."""
+        vms = self.vms
+        
+        # Verify VM configuration
+        self.assertEqual(len(vms), 3)
+        self.assertEqual(vms[0].port, 10010)
+        self.assertEqual(vms[0].peer_ports, (10011, 10012))
+        self.assertEqual(vms[1].port, 10011)
+        self.assertEqual(vms[1].peer_ports, (10010, 10012))
+        self.assertEqual(vms[2].port, 10012)
+        self.assertEqual(vms[2].peer_ports, (10010, 10011))
+    
+    def test_clock_rates_drawn_from_range(self):
+        """Test each VM gets the clock rate drawn from [min_rate, max_rate]."""
+        # Fix the draws instead of bounds-checking real random values; use a private VM list
+        with patch('main.virtual_machines', []), \
+             patch('random.randint', side_effect=[1, 6, 3]) as mock_randint:
+            vms = setup_vms(num_vms=3, base_port=10020, min_rate=1, max_rate=6)
+        
+        self.assertEqual([vm.clock_rate for vm in vms], [1, 6, 3])
+        self.assertEqual(mock_randint.call_args_list, [call(1, 6)] * 3)
     
+    @patch('multiprocessing.Process.start')  # Avoid actual process spawning
     @patch('vm.VirtualMachine.run')
     @patch('vm.VirtualMachine.stop')
-    def test_simulation_setup(self, mock_stop, mock_run):
-        """Test simulation setup with multiple VMs."""
-        # Import simulation functions
-        from main import setup_vms, run_vms, stop_vms
+    def test_run_and_stop_vms(self, mock_stop, mock_run, mock_start):
+        """Test starting and stopping multiple VMs."""
+        # Run VMs
+        run_vms(self.vms)
         
-        # Mock Process.start to avoid actual process spawning
-        with patch('multiprocessing.Process.start'):
-            # Setup VMs
-            vms = setup_vms(num_vms=3, base_port=10010)
-            
-            # Verify VM configuration
-            self.assertEqual(len(vms), 3)
-            self.assertEqual(vms[0].port, 10010)
-            self.assertEqual(vms[0].peer_ports, [10011, 10012])
-            self.assertEqual(vms[1].port, 10011)
-            self.assertEqual(vms[1].peer_ports, [10010, 10012])
-            self.assertEqual(vms[2].port, 10012)
-            self.assertEqual(vms[2].peer_ports, [10010, 10011])
-            
-            # Run VMs
-            run_vms(vms)
-            
-            # Verify all VMs were started
-            self.assertEqual(len(vms), 3)
-            
-            # Stop VMs
-            stop_vms(vms)
-            
-            # Verify all VMs were stopped
-            self.assertEqual(mock_stop.call_count, 0)
-
+        # Verify all VMs were started
+        self.assertEqual(mock_start.call_count, 3)
+        
+        # Stop VMs
+        stop_vms(self.vms)
+        
+        # Verify all VMs were stopped
+        self.assertEqual(mock_stop.call_count, 0)
+    
+    @patch('vm.VirtualMachine.run')
+    def test_run_and_stop_vms_thread_mode(self, mock_run):
+        """Test --mode thread runs each VM on a thread of this process and joins them on stop."""
+        self.assertEqual(parse_args([]).mode, "process")
+        self.assertEqual(parse_args(["--mode", "thread"]).mode, "thread")
+        
+        with patch('threading.Thread', wraps=threading.Thread) as mock_thread:
+            run_vms(self.vms, mode="thread")
+        
+        # One daemon thread per VM, each running the VM's main loop (the start pool makes its own threads)
+        vm_thread_calls = [c for c in mock_thread.call_args_list if c.kwargs.get("target") is mock_run]
+        self.assertEqual(vm_thread_calls, [call(target=mock_run, daemon=True)] * 3)
+        self.assertEqual(sorted(vm_threads), [vm.id for vm in self.vms])
+        
+        stop_vms(self.vms)
+        
+        # Every thread was joined and forgotten
+        self.assertEqual(mock_run.call_count, 3)
+        self.assertEqual(vm_threads, {})
+    
+    def test_stop_vms_kills_unresponsive_process(self):
+        """Test a VM process is asked to stop with SIGTERM, then killed if it outlives the join timeout."""
+        vm = MagicMock(id=99)
+        vm.is_alive.return_value = True  # Never exits on its own
+        
+        stop_vms([vm])
+        
+        vm.terminate.assert_called_once()
+        vm.join.assert_called_once_with(timeout=2)
+        vm.kill.assert_called_once()
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file